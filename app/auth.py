@@ -2,7 +2,10 @@
 Authentication utilities for user management and JWT tokens.
 """
 from datetime import datetime, timedelta
+from statistics import median
 from typing import Optional
+import time
+import bcrypt
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
@@ -16,7 +19,7 @@ from app import models, schemas
 pwd_context = CryptContext(
     schemes=["bcrypt"],
     deprecated="auto",
-    bcrypt__default_rounds=12,
+    bcrypt__default_rounds=settings.bcrypt_rounds or 12,
     bcrypt__default_ident="2b"
 )
 
@@ -24,6 +27,41 @@ pwd_context = CryptContext(
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login")
 
 
+def _median_hash_ms(rounds: int, samples: int = 3) -> float:
+    timings = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        bcrypt.hashpw(b"x", bcrypt.gensalt(rounds))
+        timings.append((time.perf_counter() - start) * 1000)
+    return median(timings)
+
+
+def calibrate_bcrypt_rounds(min_rounds: int = 12, max_rounds: int = 14) -> int:
+    """
+    Set the bcrypt cost for new hashes.
+    Uses settings.bcrypt_rounds if configured, otherwise the highest cost
+    whose median hash time fits settings.auth_target_ms on this host. The
+    benchmark only ever raises the cost above min_rounds (the long-standing
+    default of 12), so a slow or busy host never weakens new hashes.
+    """
+    rounds = settings.bcrypt_rounds
+    if not rounds:
+        rounds = min_rounds
+        lo, hi = min_rounds, max_rounds
+        while lo <= hi:
+            mid = (lo + hi) // 2
+            if _median_hash_ms(mid) <= settings.auth_target_ms:
+                rounds = mid
+                lo = mid + 1
+            else:
+                hi = mid - 1
+        settings.bcrypt_rounds = rounds
+
+    # Hashes below the current cost are flagged for re-hash on next login
+    pwd_context.update(bcrypt__default_rounds=rounds, bcrypt__min_rounds=rounds)
+    return rounds
+
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verify a password against a hash."""
     # Bcrypt has a 72-byte limit, truncate if necessary
@@ -32,6 +70,16 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
 
+def verify_and_update_password(
+    plain_password: str, hashed_password: str
+) -> tuple[bool, Optional[str]]:
+    """Verify a password, returning a new hash if the stored one is outdated."""
+    # Bcrypt has a 72-byte limit, truncate if necessary
+    if len(plain_password.encode('utf-8')) > 72:
+        plain_password = plain_password[:72]
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
+
 def get_password_hash(password: str) -> str:
     """Hash a password."""
     # Bcrypt has a 72-byte limit, truncate if necessary
@@ -86,7 +134,7 @@ async def get_current_user(
     except (ValueError, TypeError):
         raise credentials_exception
     
-    user = db.query(models.User).filter(models.User.id == user_id).first()
+    user = db.get(models.User, user_id)
     if user is None:
         raise credentials_exception
     
@@ -0,0 +1,78 @@
+"""
+Optional Redis cache for hot, rarely written rows (user settings).
+Every call degrades to the database when Redis is unset or unreachable.
+"""
+from typing import Optional
+
+import orjson
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app import crud, schemas
+
+try:
+    import redis.asyncio as aioredis
+    from redis.exceptions import RedisError
+except ImportError:  # Redis is optional
+    aioredis = None
+    RedisError = OSError
+
+# Cache-aside has a race: a read miss that loaded the row before a concurrent
+# write committed can SET the old row after the write's DELETE. Writers delete
+# again once the response is sent, which closes most of that window; a reader
+# slower than that can still serve stale settings for at most the TTL.
+USER_SETTINGS_TTL = 60  # seconds
+
+redis_client: Optional["aioredis.Redis"] = None
+
+
+async def init_redis():
+    """Create the shared client if REDIS_URL is configured."""
+    global redis_client
+    if settings.redis_url and aioredis is not None:
+        redis_client = aioredis.from_url(settings.redis_url)
+
+
+async def close_redis():
+    global redis_client
+    if redis_client is not None:
+        await redis_client.aclose()
+        redis_client = None
+
+
+def _user_settings_key(user_id: int) -> str:
+    return f"user_settings:{user_id}"
+
+
+async def cached_get_user_settings(user_id: int, db: Session) -> schemas.UserSettingsResponse:
+    """Get user settings from Redis, falling back to (and filling from) the DB."""
+    key = _user_settings_key(user_id)
+    if redis_client is not None:
+        try:
+            raw = await redis_client.get(key)
+            if raw:
+                return schemas.UserSettingsResponse.model_validate(orjson.loads(raw))
+        except (RedisError, OSError):
+            pass
+
+    user_settings = schemas.UserSettingsResponse.model_validate(
+        await run_in_threadpool(crud.get_user_settings, db, user_id)
+    )
+    if redis_client is not None:
+        try:
+            await redis_client.set(
+                key, orjson.dumps(user_settings.model_dump()), ex=USER_SETTINGS_TTL
+            )
+        except (RedisError, OSError):
+            pass
+    return user_settings
+
+
+async def invalidate_user_settings(user_id: int):
+    """Drop cached settings after a write; the TTL covers a failed delete."""
+    if redis_client is not None:
+        try:
+            await redis_client.delete(_user_settings_key(user_id))
+        except (RedisError, OSError):
+            pass
@@ -1,8 +1,28 @@
-from functools import lru_cache
+from pathlib import Path
+import os
+from pydantic import model_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 import secrets
 
 
+def _load_or_create_secret_key(path: Path) -> str:
+    """Read the persisted secret key, generating it once if missing."""
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(secrets.token_urlsafe(32))
+        try:
+            # Atomic create-if-absent: concurrent workers all end up on one key
+            os.link(tmp, path)
+        except FileExistsError:
+            pass
+        finally:
+            tmp.unlink()
+    return path.read_text().strip()
+
+
 class Settings(BaseSettings):
     model_config = SettingsConfigDict(
         env_file=".env", env_file_encoding="utf-8"
@@ -10,6 +30,7 @@ class Settings(BaseSettings):
 
     # Application settings
     app_name: str = "Nutrition Chat"
+    debug: bool = False  # Raise on unplanned lazy loads (N+1 guard)
     
     # LLM settings
     ollama_model: str = "llama3.2:1b"
@@ -17,25 +38,41 @@ class Settings(BaseSettings):
     ollama_api_token: str | None = None
     system_prompt: str = "You are a helpful assistant."
     memory_token_limit: int = 3200
+    ollama_num_ctx: int = 4096
+    ollama_keep_alive: str = "30m"  # Keep model weights loaded between turns
     
     # Database settings
     database_url: str = "sqlite:///./data/chat.db"
+    # Connection pool for server databases (ignored for SQLite)
+    db_pool_size: int = 20
+    db_max_overflow: int = 10
+    db_pool_recycle: int = 1800  # seconds
+    redis_url: str | None = None  # Optional cache for user settings
     
     # Security settings
-    secret_key: str = secrets.token_urlsafe(32)
+    secret_key: str | None = None  # Falls back to secret_key_file
+    secret_key_file: str = "./data/.secret_key"
     algorithm: str = "HS256"
     access_token_expire_minutes: int = 10080  # 7 days
+    bcrypt_rounds: int | None = None  # None: benchmark at startup
+    auth_target_ms: int = 250  # Target hash time when benchmarking
     
     # Admin settings (for initial setup)
     admin_user: str | None = None
     admin_password: str | None = None
     admin_email: str | None = None
 
+    @model_validator(mode="after")
+    def _ensure_secret_key(self):
+        # Shared by every worker and restart, so issued JWTs stay valid
+        if not self.secret_key:
+            self.secret_key = _load_or_create_secret_key(Path(self.secret_key_file))
+        return self
 
-@lru_cache
-def get_settings() -> Settings:
-    return Settings()
 
+# Built once at import; get_settings is a plain accessor, no cache dispatch
+settings = Settings()
 
-# Create a module-level settings instance for convenience
-settings = get_settings()
+
+def get_settings() -> Settings:
+    return settings
@@ -1,27 +1,65 @@
-from sqlalchemy.orm import Session
-from sqlalchemy import select, desc
+from sqlalchemy.orm import Session, joinedload, load_only, raiseload
+from sqlalchemy import and_, bindparam, or_, select, desc, exists, func, insert, delete, update, inspect
+from sqlalchemy.dialects import postgresql, sqlite
+from dataclasses import dataclass
 from datetime import datetime, timedelta
+from functools import lru_cache
+from threading import Lock
+import csv
+import io
 import secrets
-from typing import Optional
+from typing import Iterable, Optional
+
+from cachetools import TTLCache
 
 from app import models
-from app.auth import get_password_hash, verify_password
+from app.auth import get_password_hash, verify_and_update_password
 
 
 # User operations
+
+@dataclass(frozen=True)
+class LoginRecord:
+    """The user fields the login path needs, safe to cache across sessions."""
+    id: int
+    hashed_password: str
+    is_active: bool
+
+
+# Built once so every lookup hits the statement compilation cache
+_USER_BY_EMAIL = select(models.User).where(models.User.email == bindparam("email"))
+_USER_BY_USERNAME = select(models.User).where(models.User.username == bindparam("username"))
+
+
+# username/email -> LoginRecord; the short TTL bounds staleness across workers
+_login_cache: TTLCache = TTLCache(maxsize=1024, ttl=5)
+_login_cache_lock = Lock()
+
+
+def _invalidate_login_cache(*keys: Optional[str]):
+    with _login_cache_lock:
+        for key in keys:
+            _login_cache.pop(key, None)
+
+
 def get_user_by_id(db: Session, user_id: int) -> Optional[models.User]:
     """Get user by ID."""
-    return db.query(models.User).filter(models.User.id == user_id).first()
+    return db.get(models.User, user_id)
 
 
 def get_user_by_email(db: Session, email: str) -> Optional[models.User]:
     """Get user by email."""
-    return db.query(models.User).filter(models.User.email == email).first()
+    return db.scalar(_USER_BY_EMAIL, {"email": email})
+
+
+def user_email_exists(db: Session, email: str) -> bool:
+    """Check whether a user with this email exists, without loading it."""
+    return db.scalar(select(exists().where(models.User.email == email)))
 
 
 def get_user_by_username(db: Session, username: str) -> Optional[models.User]:
     """Get user by username."""
-    return db.query(models.User).filter(models.User.username == username).first()
+    return db.scalar(_USER_BY_USERNAME, {"username": username})
 
 
 def create_user(
@@ -42,11 +80,17 @@ def create_user(
     db.add(user)
     db.commit()
     db.refresh(user)
+    _invalidate_login_cache(username, email)
     return user
 
 
-def authenticate_user(db: Session, username: str, password: str) -> Optional[models.User]:
-    """Authenticate a user by username/email and password."""
+def get_login_record(db: Session, username: str) -> Optional[LoginRecord]:
+    """Get login fields by username/email through a short-lived cache."""
+    with _login_cache_lock:
+        record = _login_cache.get(username)
+    if record:
+        return record
+    
     # Try username first
     user = get_user_by_username(db, username)
     if not user:
@@ -56,10 +100,34 @@ def authenticate_user(db: Session, username: str, password: str) -> Optional[mod
     if not user:
         return None
     
-    if not verify_password(password, user.hashed_password):
+    record = LoginRecord(
+        id=user.id,
+        hashed_password=user.hashed_password,
+        is_active=user.is_active
+    )
+    with _login_cache_lock:
+        _login_cache[username] = record
+    return record
+
+
+def authenticate_user(db: Session, username: str, password: str) -> Optional[LoginRecord]:
+    """Authenticate a user by username/email and password."""
+    record = get_login_record(db, username)
+    if not record:
         return None
     
-    return user
+    valid, new_hash = verify_and_update_password(password, record.hashed_password)
+    if not valid:
+        return None
+    
+    # Transparently upgrade hashes made with an older bcrypt cost
+    if new_hash:
+        user = get_user_by_id(db, record.id)
+        user.hashed_password = new_hash
+        db.commit()
+        _invalidate_login_cache(username, user.username, user.email)
+    
+    return record
 
 
 def update_user(
@@ -70,6 +138,7 @@ def update_user(
     full_name: Optional[str] = None
 ) -> models.User:
     """Update user profile."""
+    _invalidate_login_cache(user.username, user.email, username, email)
     if email is not None:
         user.email = email
     if username is not None:
@@ -77,18 +146,15 @@ def update_user(
     if full_name is not None:
         user.full_name = full_name
     
-    db.add(user)
     db.commit()
-    db.refresh(user)
     return user
 
 
 def change_password(db: Session, user: models.User, new_password: str) -> models.User:
     """Change user password."""
     user.hashed_password = get_password_hash(new_password)
-    db.add(user)
     db.commit()
-    db.refresh(user)
+    _invalidate_login_cache(user.username, user.email)
     return user
 
 
@@ -123,22 +189,60 @@ def reset_password_with_token(db: Session, token: str, new_password: str) -> Opt
     db.add(user)
     db.commit()
     db.refresh(user)
+    _invalidate_login_cache(user.username, user.email)
     return user
 
 
 # Chat operations
-def list_chats(db: Session, user_id: int):
-    stmt = select(models.ChatSession).where(
-        models.ChatSession.user_id == user_id
-    ).order_by(desc(models.ChatSession.updated_at))
+def list_chats(
+    db: Session, user_id: int, limit: int | None = None, before_id: int | None = None
+):
+    """List a user's chats, most recently updated first.
+
+    Pass ``before_id`` (the last chat of the previous page) and ``limit`` to
+    page by keyset on (updated_at, id) instead of OFFSET.
+    """
+    Chat = models.ChatSession
+    # ChatRead has no relationships; fail loudly if serialization ever adds one
+    stmt = select(Chat).options(
+        load_only(Chat.id, Chat.title, Chat.created_at, Chat.updated_at),
+        raiseload("*"),
+    ).where(
+        Chat.user_id == user_id
+    ).order_by(desc(Chat.updated_at), desc(Chat.id))
+    if before_id is not None:
+        cursor = select(Chat.updated_at).where(
+            Chat.id == before_id, Chat.user_id == user_id
+        ).scalar_subquery()
+        stmt = stmt.where(or_(
+            Chat.updated_at < cursor,
+            and_(Chat.updated_at == cursor, Chat.id < before_id),
+        ))
+    if limit is not None:
+        stmt = stmt.limit(limit)
     return db.scalars(stmt).all()
 
 
-def get_chat(db: Session, chat_id: int, user_id: int) -> models.ChatSession | None:
-    return db.query(models.ChatSession).filter(
+def chat_belongs_to(db: Session, chat_id: int, user_id: int) -> bool:
+    """Ownership check as a bare EXISTS probe, without loading the chat."""
+    stmt = select(exists().where(
         models.ChatSession.id == chat_id,
         models.ChatSession.user_id == user_id
-    ).first()
+    ))
+    return db.scalar(stmt)
+
+
+def get_chat_with_context(
+    db: Session, chat_id: int, user_id: int
+) -> models.ChatSession | None:
+    """Get a user's chat with its messages in one round trip."""
+    stmt = select(models.ChatSession).options(
+        joinedload(models.ChatSession.messages)
+    ).where(
+        models.ChatSession.id == chat_id,
+        models.ChatSession.user_id == user_id
+    )
+    return db.scalars(stmt).unique().one_or_none()
 
 
 def create_chat(db: Session, user_id: int, title: str | None = None) -> models.ChatSession:
@@ -149,29 +253,72 @@ def create_chat(db: Session, user_id: int, title: str | None = None) -> models.C
     return chat
 
 
-def rename_chat(
-    db: Session, chat: models.ChatSession, title: str
-) -> models.ChatSession:
-    chat.title = title
-    db.add(chat)
+def rename_chat(db: Session, chat_id: int, user_id: int, title: str):
+    """Rename a user's chat in one UPDATE; returns the updated row or None."""
+    Chat = models.ChatSession
+    stmt = update(Chat).where(
+        Chat.id == chat_id, Chat.user_id == user_id
+    ).values(title=title).returning(
+        Chat.id, Chat.title, Chat.created_at, Chat.updated_at
+    )
+    row = db.execute(stmt).one_or_none()
     db.commit()
-    db.refresh(chat)
-    return chat
+    return row
 
 
-def delete_chat(db: Session, chat: models.ChatSession):
-    db.delete(chat)
+def delete_chat(db: Session, chat_id: int, user_id: int) -> bool:
+    """Delete a user's chat and its messages; False if no such chat."""
+    owned = select(models.ChatSession.id).where(
+        models.ChatSession.id == chat_id,
+        models.ChatSession.user_id == user_id
+    )
+    # Explicit, since SQLite only honours ON DELETE CASCADE with foreign_keys on
+    db.execute(
+        delete(models.Message).where(models.Message.chat_id.in_(owned)),
+        execution_options={"synchronize_session": False},
+    )
+    result = db.execute(
+        delete(models.ChatSession).where(
+            models.ChatSession.id == chat_id,
+            models.ChatSession.user_id == user_id
+        ),
+        execution_options={"synchronize_session": False},
+    )
     db.commit()
+    return result.rowcount > 0
 
 
 # Message operations
-def list_messages(db: Session, chat_id: int):
-    stmt = (
-        select(models.Message)
-        .where(models.Message.chat_id == chat_id)
-        .order_by(models.Message.created_at)
-    )
-    return db.scalars(stmt).all()
+def list_messages(
+    db: Session, chat_id: int, limit: int | None = None, before_id: int | None = None
+):
+    """List a chat's messages oldest first.
+
+    With ``limit``, returns the latest ``limit`` messages older than
+    ``before_id`` (keyset on (created_at, id)), still in ascending order.
+    """
+    Message = models.Message
+    stmt = select(Message).where(Message.chat_id == chat_id)
+    if before_id is not None:
+        cursor = select(Message.created_at).where(
+            Message.id == before_id, Message.chat_id == chat_id
+        ).scalar_subquery()
+        stmt = stmt.where(or_(
+            Message.created_at < cursor,
+            and_(Message.created_at == cursor, Message.id < before_id),
+        ))
+    if limit is None:
+        return db.scalars(stmt.order_by(Message.created_at, Message.id)).all()
+    stmt = stmt.order_by(desc(Message.created_at), desc(Message.id)).limit(limit)
+    return db.scalars(stmt).all()[::-1]
+
+
+def messages_fingerprint(db: Session, chat_id: int) -> tuple[int, datetime | None]:
+    """(message count, latest created_at) for a chat, from one aggregate query."""
+    stmt = select(
+        func.count(models.Message.id), func.max(models.Message.created_at)
+    ).where(models.Message.chat_id == chat_id)
+    return tuple(db.execute(stmt).one())
 
 
 def add_message(
@@ -179,15 +326,27 @@ def add_message(
 ) -> models.Message:
     message = models.Message(chat_id=chat.id, role=role, content=content)
     db.add(message)
-    chat.updated_at = datetime.utcnow()
-    db.add(chat)
+    # Bump the chat's position in the list; rendered as SQL UTC now in the UPDATE
+    chat.updated_at = models.utcnow()
     db.commit()
-    db.refresh(message)
-    db.refresh(chat)
     return message
 
 
 # Ingredient operations
+
+# Per-user write counter, bumped by every ingredient mutation in this process
+_ingredient_versions: dict[int, int] = {}
+# user_id -> (version, rendered prompt block); the TTL bounds staleness across workers
+_ingredient_cache: TTLCache = TTLCache(maxsize=1024, ttl=60)
+_ingredient_cache_lock = Lock()
+
+
+def _bump_ingredient_version(user_id: int):
+    with _ingredient_cache_lock:
+        _ingredient_versions[user_id] = _ingredient_versions.get(user_id, 0) + 1
+        _ingredient_cache.pop(user_id, None)
+
+
 def list_ingredients(db: Session, user_id: int):
     stmt = select(models.Ingredient).where(
         models.Ingredient.user_id == user_id
@@ -195,18 +354,208 @@ def list_ingredients(db: Session, user_id: int):
     return db.scalars(stmt).all()
 
 
-def clear_ingredients(db: Session, user_id: int):
-    db.query(models.Ingredient).filter(models.Ingredient.user_id == user_id).delete()
-    db.commit()
+def count_ingredients(db: Session, user_id: int) -> int:
+    stmt = select(func.count(models.Ingredient.id)).where(
+        models.Ingredient.user_id == user_id
+    )
+    return db.scalar(stmt)
+
+
+def list_ingredients_for_prompt(db: Session, user_id: int):
+    """List ingredient columns as plain row tuples, skipping ORM hydration."""
+    stmt = select(
+        models.Ingredient.name,
+        models.Ingredient.calories_per_gram,
+        models.Ingredient.protein_per_gram,
+        models.Ingredient.fat_per_gram,
+        models.Ingredient.carbs_per_gram,
+    ).where(
+        models.Ingredient.user_id == user_id
+    ).order_by(models.Ingredient.name)
+    return db.execute(stmt).all()
+
+
+def stream_ingredients(db: Session, user_id: int, batch_size: int = 1000):
+    """Yield ingredient column tuples in id-ordered batches (keyset pagination)."""
+    stmt = select(
+        models.Ingredient.id,
+        models.Ingredient.name,
+        models.Ingredient.calories_per_gram,
+        models.Ingredient.protein_per_gram,
+        models.Ingredient.fat_per_gram,
+        models.Ingredient.carbs_per_gram,
+    ).where(
+        models.Ingredient.user_id == user_id
+    ).order_by(models.Ingredient.id).limit(batch_size)
+    last_id = 0
+    while True:
+        # Short indexed range query per batch instead of one long-lived cursor
+        rows = db.execute(stmt.where(models.Ingredient.id > last_id)).all()
+        if not rows:
+            return
+        last_id = rows[-1].id
+        yield [row[1:] for row in rows]
+
+
+INGREDIENT_COPY_COLUMNS = (
+    "user_id", "name", "calories_per_gram", "protein_per_gram",
+    "fat_per_gram", "carbs_per_gram", "created_at",
+)
+_INGREDIENT_COPY_SQL = (
+    f"COPY {models.Ingredient.__tablename__} ({', '.join(INGREDIENT_COPY_COLUMNS)}) "
+    # An unquoted empty field is NULL in COPY csv; blank names must stay ''
+    "FROM STDIN WITH (FORMAT csv, FORCE_NOT_NULL (name))"
+)
+
+
+def _copy_ingredient_rows(db: Session, user_id: int, rows: list[dict]):
+    """Stream rows into PostgreSQL with a single COPY FROM STDIN."""
+    created_at = datetime.utcnow()
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for data in rows:
+        writer.writerow((
+            user_id,
+            data["name"],
+            data["calories_per_gram"],
+            data["protein_per_gram"],
+            data["fat_per_gram"],
+            data["carbs_per_gram"],
+            created_at,
+        ))
+    buffer.seek(0)
+    # Runs on the session's own connection, so it joins the open transaction
+    cursor = db.connection().connection.cursor()
+    try:
+        cursor.copy_expert(_INGREDIENT_COPY_SQL, buffer)
+    finally:
+        cursor.close()
+
+
+def _insert_ingredient_rows(db: Session, user_id: int, rows: list[dict]):
+    """Insert a batch of ingredient rows without per-row round-trips."""
+    if not rows:
+        return
+    if db.get_bind().dialect.driver == "psycopg2":
+        _copy_ingredient_rows(db, user_id, rows)
+        return
+    # Core executemany insert: no per-row ORM state or identity map work
+    db.execute(
+        insert(models.Ingredient),
+        [{**data, "user_id": user_id} for data in rows],
+    )
 
 
-def bulk_create_ingredients(db: Session, user_id: int, ingredients_data: list[dict]):
-    ingredients = [
-        models.Ingredient(user_id=user_id, **data)
-        for data in ingredients_data
-    ]
-    db.bulk_save_objects(ingredients)
-    db.commit()
+# Dialects whose insert() supports ON CONFLICT (user_id, name) DO UPDATE
+_UPSERT_INSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+_INGREDIENT_UPSERT_COLUMNS = (
+    "calories_per_gram", "protein_per_gram", "fat_per_gram", "carbs_per_gram",
+    "created_at",
+)
+
+
+@lru_cache(maxsize=None)
+def _has_ingredient_name_key(bind) -> bool:
+    """Whether the live ingredients table has the (user_id, name) unique key.
+
+    create_all never adds it to a table created before the constraint, and
+    ON CONFLICT needs it; checked once per engine.
+    """
+    inspector = inspect(bind)
+    keys = [c["column_names"] for c in inspector.get_unique_constraints("ingredients")]
+    keys += [i["column_names"] for i in inspector.get_indexes("ingredients") if i["unique"]]
+    return any(sorted(key) == ["name", "user_id"] for key in keys)
+
+
+def _upsert_ingredient_rows(
+    db: Session, user_id: int, rows: list[dict], created_at: datetime
+):
+    """Insert or update a batch of ingredient rows keyed on (user_id, name)."""
+    stmt = _UPSERT_INSERTS[db.get_bind().dialect.name](models.Ingredient)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["user_id", "name"],
+        set_={col: stmt.excluded[col] for col in _INGREDIENT_UPSERT_COLUMNS},
+    )
+    db.execute(
+        stmt,
+        [{**data, "user_id": user_id, "created_at": created_at} for data in rows],
+    )
+
+
+def replace_ingredients(
+    db: Session, user_id: int, batches: Iterable[list[dict]]
+) -> int:
+    """Replace a user's ingredients with row batches in a single transaction.
+
+    Names are unique per user; the first row for a name wins. When the user
+    already has ingredients and the table has its (user_id, name) key, rows
+    are upserted and names missing from the upload are deleted afterwards, so
+    unchanged rows keep their ids; otherwise old rows are deleted first.
+    """
+    upload_time = datetime.utcnow()
+    seen: set[str] = set()
+    try:
+        bind = db.get_bind()
+        upsert = (
+            bind.dialect.name in _UPSERT_INSERTS
+            and _has_ingredient_name_key(bind)
+            and count_ingredients(db, user_id) > 0
+        )
+        if not upsert:
+            db.execute(delete(models.Ingredient).where(models.Ingredient.user_id == user_id))
+        for batch in batches:
+            rows = []
+            for data in batch:
+                if data["name"] not in seen:
+                    seen.add(data["name"])
+                    rows.append(data)
+            if not rows:
+                continue
+            if upsert:
+                _upsert_ingredient_rows(db, user_id, rows, upload_time)
+            else:
+                _insert_ingredient_rows(db, user_id, rows)
+        if upsert:
+            # Every row in this upload carries upload_time; the rest are stale
+            db.execute(
+                delete(models.Ingredient).where(
+                    models.Ingredient.user_id == user_id,
+                    models.Ingredient.created_at.is_distinct_from(upload_time),
+                )
+            )
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        _bump_ingredient_version(user_id)
+    return len(seen)
+
+
+def get_ingredient_prompt_block(db: Session, user_id: int) -> str:
+    """Get the ingredient context block for the LLM prompt, cached per user."""
+    with _ingredient_cache_lock:
+        version = _ingredient_versions.get(user_id, 0)
+        cached = _ingredient_cache.get(user_id)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    rows = "\n".join(
+        f"- {name}: {cal:.2f} cal, {protein:.2f}g protein, {fat:.2f}g fat, {carbs:.2f}g carbs"
+        for name, cal, protein, fat, carbs in list_ingredients_for_prompt(db, user_id)
+    )
+    block = ""
+    if rows:
+        block = (
+            f"\n\nKnown ingredient nutritional data (per gram):\n{rows}\n"
+            "\n\nSearch other ingredients is they are not found in the list above."
+        )
+
+    with _ingredient_cache_lock:
+        # Skip the store if a write landed while the block was being built
+        if _ingredient_versions.get(user_id, 0) == version:
+            _ingredient_cache[user_id] = (version, block)
+    return block
 
 
 # User Settings operations
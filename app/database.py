@@ -1,20 +1,46 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
-
-from app.config import get_settings
-
-settings = get_settings()
-engine = create_engine(
-    settings.database_url,
-    connect_args=(
-        {"check_same_thread": False}
-        if settings.database_url.startswith("sqlite")
-        else {}
-    ),
-)
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker, declarative_base, raiseload
+
+from app.config import settings
+
+if settings.database_url.startswith("sqlite"):
+    engine_options = {"connect_args": {"check_same_thread": False}}
+else:
+    # Reuse warm connections across requests; pre-ping drops dead ones after
+    # server restarts, LIFO lets idle extras time out server-side
+    engine_options = {
+        "pool_size": settings.db_pool_size,
+        "max_overflow": settings.db_max_overflow,
+        "pool_recycle": settings.db_pool_recycle,
+        "pool_pre_ping": True,
+        "pool_use_lifo": True,
+    }
+
+engine = create_engine(settings.database_url, **engine_options)
+
+if settings.database_url.startswith("sqlite"):
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragma(dbapi_connection, connection_record):
+        # WAL + NORMAL sync: one fsync per transaction commit instead of per write
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+if settings.debug:
+    @event.listens_for(SessionLocal, "do_orm_execute")
+    def _raiseload_by_default(execute_state):
+        # Relationships must be loaded explicitly; lazy loads become errors
+        if (
+            execute_state.is_select
+            and not execute_state.is_column_load
+            and not execute_state.is_relationship_load
+        ):
+            execute_state.statement = execute_state.statement.options(raiseload("*"))
+
 
 def get_db():
     db = SessionLocal()
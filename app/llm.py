@@ -1,4 +1,5 @@
-from typing import Iterable
+from functools import lru_cache
+from typing import AsyncIterator, Sequence
 
 import ollama
 
@@ -6,6 +7,24 @@ from app.config import Settings
 from app import models
 
 
+@lru_cache(maxsize=64)
+def _build_context(
+    system_prompt: str, ingredient_block: str, macro_key: tuple | None
+) -> tuple[str, str]:
+    """Return (system content, user message suffix) for a prompt context."""
+    system_content = system_prompt + ingredient_block
+    macro_text = ""
+    if macro_key:
+        protein_pct, carbs_pct, fat_pct = macro_key
+        macro_text = f"\n\nMeal composition must be {protein_pct}% protein, {carbs_pct}% carbs, {fat_pct}% fat."
+    return system_content, macro_text
+
+
+def _estimate_tokens(text: str) -> int:
+    # ~4 characters per token; cheap and slightly conservative
+    return len(text) // 4 + 1
+
+
 class LLMService:
     def __init__(self, settings: Settings):
         self.settings = settings
@@ -13,54 +32,64 @@ class LLMService:
         client_kwargs = {"host": settings.ollama_api_base}
         if settings.ollama_api_token:
             client_kwargs["headers"] = {"Authorization": f"Bearer {settings.ollama_api_token}"}
-        self.client = ollama.Client(**client_kwargs)
+        self.aclient = ollama.AsyncClient(**client_kwargs)
+        # Same model options on every call so Ollama never reloads the model
+        self._chat_kwargs = {
+            "model": settings.ollama_model,
+            "options": {"num_ctx": settings.ollama_num_ctx},
+            "keep_alive": settings.ollama_keep_alive,
+        }
+
+    async def awarm_up(self):
+        """Load the model ahead of the first chat; failures are only logged."""
+        try:
+            await self.aclient.generate(
+                model=self.settings.ollama_model,
+                prompt="",
+                keep_alive=self.settings.ollama_keep_alive,
+            )
+        except Exception as e:
+            print(f"✗ Ollama warm-up failed: {e}")
 
-    def chat(
-        self, history: Iterable[models.Message], user_message: str, ingredients: list[models.Ingredient] | None = None,
+    def build_messages(
+        self, history: Sequence[models.Message], user_message: str, ingredient_block: str = "",
         user_settings: models.UserSettings | None = None
-    ) -> str:
-        # Build messages list for chat API
-        messages = []
-        
-        # Add system prompt if configured
-        system_content = self.settings.system_prompt or ""
-        
-        # Add ingredient data to system context if available
-        add_content = ""
-        if ingredients:
-            ingredient_data = "\n\nKnown ingredient nutritional data (per gram):\n"
-            for ing in ingredients:
-                ingredient_data += f"- {ing.name}: {ing.calories_per_gram:.2f} cal, {ing.protein_per_gram:.2f}g protein, {ing.fat_per_gram:.2f}g fat, {ing.carbs_per_gram:.2f}g carbs\n"
-            add_content += ingredient_data
-            add_content += "\n\nSearch other ingredients is they are not found in the list above."
-        
-        
+    ) -> list[dict]:
+        # System prompt plus ingredient data (prebuilt and cached by
+        # crud.get_ingredient_prompt_block), memoized with the macro text
+        macro_key = None
         if user_settings and user_settings.macro_enabled:
-            macro_text = f"\n\nMeal composition must be {user_settings.protein_pct}% protein, {user_settings.carbs_pct}% carbs, {user_settings.fat_pct}% fat."
-            user_message = user_message + macro_text
-
-        
-        if system_content:
-            messages.append({
-                "role": "system",
-                "content": system_content
-            })
+            macro_key = (user_settings.protein_pct, user_settings.carbs_pct, user_settings.fat_pct)
+        system_content, macro_text = _build_context(
+            self.settings.system_prompt or "", ingredient_block, macro_key
+        )
         
-        for msg in history:
-            messages.append({
-                "role": msg.role,
-                "content": msg.content + (add_content if msg.role == "user" else "")
-            })
+        # Keep the most recent turns that fit within memory_token_limit
+        budget = self.settings.memory_token_limit
+        start = len(history)
+        while start > 0:
+            budget -= _estimate_tokens(history[start - 1].content)
+            if budget < 0:
+                break
+            start -= 1
         
-        messages.append({
-            "role": "user",
-            "content": user_message + add_content
-        })
+        # Build messages list for chat API
+        messages = [{"role": "system", "content": system_content}] if system_content else []
+        messages.extend({"role": msg.role, "content": msg.content} for msg in history[start:])
+        messages.append({"role": "user", "content": user_message + macro_text})
         
-        # Use native ollama chat API
-        response = self.client.chat(
-            model=self.settings.ollama_model,
-            messages=messages,
-        )
+        return messages
+
+    async def achat(self, messages: list[dict]) -> str:
+        """Async chat completion for messages prepared by build_messages."""
+        response = await self.aclient.chat(messages=messages, **self._chat_kwargs)
         
         return response["message"]["content"]
+
+    async def achat_stream(self, messages: list[dict]) -> AsyncIterator[str]:
+        """Stream completion tokens for messages prepared by build_messages."""
+        stream = await self.aclient.chat(
+            messages=messages, stream=True, **self._chat_kwargs
+        )
+        async for chunk in stream:
+            yield chunk["message"]["content"]
@@ -1,36 +1,37 @@
+import asyncio
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import List
+from typing import List, Optional
 import csv
 import io
+import json
 from datetime import timedelta
 
-from fastapi import Depends, FastAPI, HTTPException, UploadFile, File, status
+from fastapi import BackgroundTasks, Depends, FastAPI, HTTPException, Query, Request, UploadFile, File, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import StreamingResponse
+from fastapi.responses import Response, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy.orm import Session
 
-from app.config import get_settings
-from app.database import Base, engine, get_db
-from app import crud, schemas, models
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pacsv
+except ImportError:  # Optional: faster native CSV parsing for uploads
+    pacsv = None
+
+from app.config import settings
+from app.database import Base, SessionLocal, engine, get_db
+from app import cache, crud, schemas, models
 from app.llm import LLMService
 from app.auth import (
     get_current_active_user,
     create_access_token,
     verify_password,
-    validate_password_strength
-)
-
-settings = get_settings()
-app = FastAPI(title=settings.app_name)
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    validate_password_strength,
+    calibrate_bcrypt_rounds
 )
 
 # Create database tables and ensure data folder exists for SQLite
@@ -44,25 +45,48 @@ Base.metadata.create_all(bind=engine)
 # Create admin user if configured
 def create_admin_user():
     """Create admin user on startup if configured in .env"""
-    if settings.admin_email and settings.admin_user and settings.admin_password:
-        db = next(get_db())
-        try:
-            existing = crud.get_user_by_email(db, settings.admin_email)
-            if not existing:
-                crud.create_user(
-                    db,
-                    email=settings.admin_email,
-                    username=settings.admin_user,
-                    password=settings.admin_password,
-                    full_name="Administrator"
-                )
-                print(f"✓ Admin user created: {settings.admin_user}")
-            else:
-                print(f"✓ Admin user exists: {settings.admin_user}")
-        finally:
-            db.close()
+    if not (settings.admin_email and settings.admin_user and settings.admin_password):
+        return
+    db = SessionLocal()
+    try:
+        # Cheap EXISTS probe; only hash the password when actually creating
+        if crud.user_email_exists(db, settings.admin_email):
+            print(f"✓ Admin user exists: {settings.admin_user}")
+            return
+        crud.create_user(
+            db,
+            email=settings.admin_email,
+            username=settings.admin_user,
+            password=settings.admin_password,
+            full_name="Administrator"
+        )
+        print(f"✓ Admin user created: {settings.admin_user}")
+    finally:
+        db.close()
 
-create_admin_user()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """One-shot startup work, kept off import and the request path."""
+    print(f"✓ bcrypt cost: {calibrate_bcrypt_rounds()}")
+    create_admin_user()
+    # Load the model in the background so the first chat is not a cold start
+    warm_up = asyncio.create_task(llm_service.awarm_up())
+    await cache.init_redis()
+    yield
+    warm_up.cancel()
+    await cache.close_redis()
+
+
+app = FastAPI(title=settings.app_name, lifespan=lifespan)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
 
 llm_service = LLMService(settings)
 
@@ -180,7 +204,7 @@ def update_profile(
     return user
 
 
-@app.post("/api/auth/change-password")
+@app.post("/api/auth/change-password", response_model=schemas.MessageResponse)
 def change_password(
     password_data: schemas.PasswordChange,
     current_user: models.User = Depends(get_current_active_user),
@@ -207,7 +231,11 @@ def change_password(
     return {"message": "Password changed successfully"}
 
 
-@app.post("/api/auth/request-password-reset")
+@app.post(
+    "/api/auth/request-password-reset",
+    response_model=schemas.PasswordResetRequested,
+    response_model_exclude_none=True,
+)
 def request_password_reset(
     request_data: schemas.PasswordResetRequest,
     db: Session = Depends(get_db)
@@ -228,7 +256,7 @@ def request_password_reset(
     return {"message": "Password reset instructions sent to email"}
 
 
-@app.post("/api/auth/reset-password")
+@app.post("/api/auth/reset-password", response_model=schemas.MessageResponse)
 def reset_password(
     reset_data: schemas.PasswordReset,
     db: Session = Depends(get_db)
@@ -256,7 +284,7 @@ def reset_password(
 # Configuration Endpoints
 # ============================================================================
 
-@app.get("/api/config")
+@app.get("/api/config", response_model=schemas.ConfigResponse)
 def get_config():
     """Return public configuration info for display in UI"""
     return {
@@ -269,12 +297,19 @@ def get_config():
 # Chat Endpoints (Protected)
 # ============================================================================
 
+# Upper bound for the optional ?limit= on list endpoints
+MAX_PAGE_SIZE = 200
+
 @app.get("/api/chats", response_model=List[schemas.ChatRead])
 def list_chats(
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    before_id: Optional[int] = None,
     current_user: models.User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
-    return crud.list_chats(db, user_id=current_user.id)
+    return crud.list_chats(
+        db, user_id=current_user.id, limit=limit, before_id=before_id
+    )
 
 
 @app.post("/api/chats", response_model=schemas.ChatRead)
@@ -294,25 +329,22 @@ def rename_chat(
     current_user: models.User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
-    chat = crud.get_chat(db, chat_id, user_id=current_user.id)
-    if not chat:
-        raise HTTPException(status_code=404, detail="Chat not found")
     if not payload.title:
         raise HTTPException(status_code=400, detail="Title is required")
-    chat = crud.rename_chat(db, chat, payload.title)
+    chat = crud.rename_chat(db, chat_id, user_id=current_user.id, title=payload.title)
+    if not chat:
+        raise HTTPException(status_code=404, detail="Chat not found")
     return chat
 
 
-@app.delete("/api/chats/{chat_id}")
+@app.delete("/api/chats/{chat_id}", response_model=schemas.StatusResponse)
 def delete_chat(
     chat_id: int,
     current_user: models.User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
-    chat = crud.get_chat(db, chat_id, user_id=current_user.id)
-    if not chat:
+    if not crud.delete_chat(db, chat_id, user_id=current_user.id):
         raise HTTPException(status_code=404, detail="Chat not found")
-    crud.delete_chat(db, chat)
     return {"status": "ok"}
 
 
@@ -321,58 +353,223 @@ def delete_chat(
 )
 def get_messages(
     chat_id: int,
+    request: Request,
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    before_id: Optional[int] = None,
     current_user: models.User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
-    chat = crud.get_chat(db, chat_id, user_id=current_user.id)
+    if not crud.chat_belongs_to(db, chat_id, user_id=current_user.id):
+        raise HTTPException(status_code=404, detail="Chat not found")
+
+    # Pollers get a bodiless 304 until a message is added
+    count, latest = crud.messages_fingerprint(db, chat_id)
+    etag = f'W/"{count}-{latest.timestamp() if latest else 0}"'
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+    response.headers["ETag"] = etag
+    return crud.list_messages(db, chat_id, limit=limit, before_id=before_id)
+
+
+def _load_chat_context(db: Session, chat_id: int, user_id: int):
+    # Chat with its history in one query, plus the cached ingredient block
+    chat = crud.get_chat_with_context(db, chat_id, user_id=user_id)
+    if not chat:
+        return None, ""
+    return chat, crud.get_ingredient_prompt_block(db, user_id=user_id)
+
+
+async def _prepare_chat_turn(
+    db: Session, chat_id: int, user_id: int, user_content: str
+) -> tuple[models.ChatSession, list[dict]]:
+    """Load chat context in the threadpool and build the LLM prompt."""
+    # Get user settings to check for macro composition. Fetched first: for a
+    # new user this commits a default row, which would expire a loaded chat.
+    settings = await cache.cached_get_user_settings(user_id, db)
+
+    chat, ingredient_block = await run_in_threadpool(
+        _load_chat_context, db, chat_id, user_id
+    )
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
-    return crud.list_messages(db, chat_id)
+
+    # Build the prompt before any later commit expires ORM state
+    messages = llm_service.build_messages(
+        chat.messages, user_content, ingredient_block=ingredient_block, user_settings=settings
+    )
+    return chat, messages
 
 
-@app.post("/api/chats/{chat_id}/messages")
-def send_message(
+def _save_message(chat_id: int, role: str, content: str):
+    """Persist a message with its own session, for work that outlives the request."""
+    db = SessionLocal()
+    try:
+        chat = db.get(models.ChatSession, chat_id)
+        if chat:  # Chat may have been deleted meanwhile
+            crud.add_message(db, chat, role=role, content=content)
+    finally:
+        db.close()
+
+
+@app.post("/api/chats/{chat_id}/messages", response_model=schemas.ChatTurn)
+async def send_message(
     chat_id: int,
     payload: schemas.MessageCreate,
+    background_tasks: BackgroundTasks,
     current_user: models.User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
-    chat = crud.get_chat(db, chat_id, user_id=current_user.id)
-    if not chat:
-        raise HTTPException(status_code=404, detail="Chat not found")
-
-    # Get user settings to check for macro composition
-    settings = crud.get_user_settings(db, user_id=current_user.id)
-    
     user_content = payload.content
-
-    history = crud.list_messages(db, chat_id)
-    user_message = crud.add_message(
-        db, chat, role="user", content=user_content
-    )
-
-    # Get ingredient data for context (user-specific)
-    ingredients = crud.list_ingredients(db, user_id=current_user.id)
-
-    assistant_reply = llm_service.chat(
-        [*history, user_message], user_content, ingredients=ingredients, user_settings=settings
-    )
-    assistant_message = crud.add_message(
-        db, chat, role="assistant", content=assistant_reply
+    chat, messages = await _prepare_chat_turn(db, chat_id, current_user.id, user_content)
+
+    # Persist the user message while the LLM request is in flight. Both must
+    # finish before raising so the session is never closed under the write.
+    results = await asyncio.gather(
+        run_in_threadpool(crud.add_message, db, chat, "user", user_content),
+        llm_service.achat(messages),
+        return_exceptions=True,
     )
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    assistant_reply = results[1]
+    # Saved after the response is sent, in its own session
+    background_tasks.add_task(_save_message, chat_id, "assistant", assistant_reply)
 
     return {
-        "chat_id": chat.id,
-        "user_message": user_message.content,
-        "assistant_message": assistant_message.content,
+        "chat_id": chat_id,
+        "user_message": user_content,
+        "assistant_message": assistant_reply,
     }
 
 
+@app.post("/api/chats/{chat_id}/messages/stream")
+async def send_message_stream(
+    chat_id: int,
+    payload: schemas.MessageCreate,
+    current_user: models.User = Depends(get_current_active_user),
+    db: Session = Depends(get_db)
+):
+    """Send a message and stream the reply as Server-Sent Events."""
+    chat, messages = await _prepare_chat_turn(db, chat_id, current_user.id, payload.content)
+    await run_in_threadpool(crud.add_message, db, chat, "user", payload.content)
+
+    async def event_generator():
+        parts = []
+        try:
+            async for token in llm_service.achat_stream(messages):
+                parts.append(token)
+                yield f"data: {json.dumps({'delta': token})}\n\n"
+        except Exception as e:
+            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+            return
+        # Persist the full reply once, after the last token
+        await run_in_threadpool(_save_message, chat_id, "assistant", "".join(parts))
+        yield f"data: {json.dumps({'done': True})}\n\n"
+
+    return StreamingResponse(
+        event_generator(),
+        media_type="text/event-stream",
+        # Keep caches and reverse proxies (nginx) from buffering the tokens
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 # ============================================================================
 # Ingredient Endpoints (Protected)
 # ============================================================================
 
-@app.post("/api/ingredients/upload")
+INGREDIENT_CSV_COLUMNS = ['name', 'calories_per_gram', 'protein_per_gram', 'fat_per_gram', 'carbs_per_gram']
+
+
+def _iter_ingredient_batches(reader: csv.DictReader, batch_size: int = 1000):
+    """Parse CSV rows into ingredient dicts, yielded in fixed-size batches."""
+    batch = []
+    for row in reader:
+        try:
+            batch.append({
+                'name': row['name'].strip(),
+                'calories_per_gram': float(row['calories_per_gram']),
+                'protein_per_gram': float(row['protein_per_gram']),
+                'fat_per_gram': float(row['fat_per_gram']),
+                'carbs_per_gram': float(row['carbs_per_gram'])
+            })
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            raise HTTPException(status_code=400, detail=f"Invalid data format: {str(e)}")
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _iter_arrow_ingredient_batches(csv_file, batch_size: int = 1000):
+    """Stream the CSV through pyarrow's native reader, yielded in fixed-size batches."""
+    # Validate columns from the header line, before any rows are parsed
+    header = csv_file.readline().decode('utf-8-sig', errors='replace')
+    csv_file.seek(0)
+    if not set(INGREDIENT_CSV_COLUMNS).issubset(next(csv.reader([header]), [])):
+        raise HTTPException(status_code=400, detail=f"CSV must contain columns: {', '.join(INGREDIENT_CSV_COLUMNS)}")
+
+    try:
+        # Reads one block at a time, so memory stays bounded for any file size
+        reader = pacsv.open_csv(
+            csv_file,
+            convert_options=pacsv.ConvertOptions(
+                include_columns=INGREDIENT_CSV_COLUMNS,
+                column_types={
+                    'name': pa.string(),
+                    'calories_per_gram': pa.float64(),
+                    'protein_per_gram': pa.float64(),
+                    'fat_per_gram': pa.float64(),
+                    'carbs_per_gram': pa.float64(),
+                },
+            ),
+        )
+        for record_batch in reader:
+            for column in INGREDIENT_CSV_COLUMNS:
+                if record_batch.column(column).null_count:
+                    raise HTTPException(status_code=400, detail=f"Invalid data format: missing values in '{column}'")
+            record_batch = record_batch.set_column(
+                0, 'name', pc.utf8_trim_whitespace(record_batch.column('name'))
+            )
+            for offset in range(0, record_batch.num_rows, batch_size):
+                yield record_batch.slice(offset, batch_size).to_pylist()
+    except pa.ArrowInvalid as e:
+        raise HTTPException(status_code=400, detail=f"Invalid data format: {str(e)}")
+
+
+def _import_ingredients_csv(db: Session, user_id: int, csv_file) -> int:
+    """Stream a binary CSV file into the user's ingredients, replacing old rows."""
+    if pacsv is not None:
+        # Upsert the new rows and drop stale ones (user-specific) in one transaction
+        return crud.replace_ingredients(
+            db, user_id, _iter_arrow_ingredient_batches(csv_file)
+        )
+
+    # Decode in buffered chunks straight off the spooled upload; newline=''
+    # leaves quoted line breaks to the csv module
+    text_file = io.TextIOWrapper(csv_file, encoding='utf-8-sig', newline='')
+    try:
+        reader = csv.DictReader(text_file)
+
+        # Validate columns
+        required_cols = set(INGREDIENT_CSV_COLUMNS)
+        if not required_cols.issubset(set(reader.fieldnames or [])):
+            raise HTTPException(status_code=400, detail=f"CSV must contain columns: {', '.join(INGREDIENT_CSV_COLUMNS)}")
+
+        return crud.replace_ingredients(db, user_id, _iter_ingredient_batches(reader))
+    finally:
+        # Hand the upload back unclosed; UploadFile owns it
+        text_file.detach()
+
+
+@app.post(
+    "/api/ingredients/upload", response_model=schemas.IngredientUploadResult
+)
 async def upload_ingredients(
     file: UploadFile = File(...),
     current_user: models.User = Depends(get_current_active_user),
@@ -383,35 +580,14 @@ async def upload_ingredients(
         raise HTTPException(status_code=400, detail="File must be a CSV")
     
     try:
-        contents = await file.read()
-        csv_data = contents.decode('utf-8')
-        reader = csv.DictReader(io.StringIO(csv_data))
-        
-        # Validate columns
-        required_cols = {'name', 'calories_per_gram', 'protein_per_gram', 'fat_per_gram', 'carbs_per_gram'}
-        if not required_cols.issubset(set(reader.fieldnames or [])):
-            raise HTTPException(status_code=400, detail=f"CSV must contain columns: {', '.join(required_cols)}")
-        
-        # Parse data
-        ingredients_data = []
-        for row in reader:
-            try:
-                ingredients_data.append({
-                    'name': row['name'].strip(),
-                    'calories_per_gram': float(row['calories_per_gram']),
-                    'protein_per_gram': float(row['protein_per_gram']),
-                    'fat_per_gram': float(row['fat_per_gram']),
-                    'carbs_per_gram': float(row['carbs_per_gram'])
-                })
-            except (ValueError, KeyError) as e:
-                raise HTTPException(status_code=400, detail=f"Invalid data format: {str(e)}")
-        
-        # Clear existing and save new (user-specific)
-        crud.clear_ingredients(db, user_id=current_user.id)
-        crud.bulk_create_ingredients(db, user_id=current_user.id, ingredients_data=ingredients_data)
-        
-        return {"message": f"Successfully uploaded {len(ingredients_data)} ingredients", "count": len(ingredients_data)}
+        # Parse and insert off the event loop; memory stays at one batch
+        count = await run_in_threadpool(
+            _import_ingredients_csv, db, current_user.id, file.file
+        )
+        return {"message": f"Successfully uploaded {count} ingredients", "count": count}
     
+    except HTTPException:
+        raise
     except UnicodeDecodeError:
         raise HTTPException(status_code=400, detail="File encoding error. Please use UTF-8 encoded CSV")
     except Exception as e:
@@ -420,36 +596,45 @@ async def upload_ingredients(
 
 @app.get("/api/ingredients/download")
 def download_ingredients(
-    current_user: models.User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    current_user: models.User = Depends(get_current_active_user)
 ):
     """Download ingredient data as CSV"""
-    ingredients = crud.list_ingredients(db, user_id=current_user.id)
-    
-    # Create CSV in memory
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(['name', 'calories_per_gram', 'protein_per_gram', 'fat_per_gram', 'carbs_per_gram'])
-    
-    for ing in ingredients:
-        writer.writerow([ing.name, ing.calories_per_gram, ing.protein_per_gram, ing.fat_per_gram, ing.carbs_per_gram])
-    
-    output.seek(0)
+    user_id = current_user.id
+
+    def generate_csv():
+        # Own session: the body is streamed after the endpoint has returned
+        db = SessionLocal()
+        try:
+            output = io.StringIO()
+            writer = csv.writer(output)
+            writer.writerow(INGREDIENT_CSV_COLUMNS)
+            yield output.getvalue()
+
+            for batch in crud.stream_ingredients(db, user_id=user_id):
+                # End the read transaction so the connection goes back to the
+                # pool while this batch is formatted and sent
+                db.rollback()
+                output.seek(0)
+                output.truncate()
+                writer.writerows(batch)
+                yield output.getvalue()
+        finally:
+            db.close()
+
     return StreamingResponse(
-        iter([output.getvalue()]),
+        generate_csv(),
         media_type="text/csv",
         headers={"Content-Disposition": "attachment; filename=ingredients.csv"}
     )
 
 
-@app.get("/api/ingredients/count")
+@app.get("/api/ingredients/count", response_model=schemas.IngredientCount)
 def get_ingredients_count(
     current_user: models.User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Get count of loaded ingredients"""
-    ingredients = crud.list_ingredients(db, user_id=current_user.id)
-    return {"count": len(ingredients)}
+    return {"count": crud.count_ingredients(db, user_id=current_user.id)}
 
 
 @app.get("/api/ingredients", response_model=list[schemas.IngredientRead])
@@ -467,39 +652,25 @@ def list_ingredients(
 # ============================================================================
 
 @app.get("/api/settings", response_model=schemas.UserSettingsResponse)
-def get_settings(
+async def get_settings(
     current_user: models.User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Get current user settings."""
-    settings = crud.get_user_settings(db, user_id=current_user.id)
-    return settings
+    return await cache.cached_get_user_settings(current_user.id, db)
 
 
 @app.put("/api/settings", response_model=schemas.UserSettingsResponse)
-def update_settings(
+async def update_settings(
     settings_data: schemas.UserSettingsUpdate,
+    background_tasks: BackgroundTasks,
     current_user: models.User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Update user settings."""
-    # Validate sum if macro enabled and all percentages provided
-    if settings_data.macro_enabled:
-        if settings_data.protein_pct is None or settings_data.carbs_pct is None or settings_data.fat_pct is None:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="All macro percentages (protein, carbs, fat) are required when macro composition is enabled"
-            )
-        
-        try:
-            settings_data.validate_sum()
-        except ValueError as e:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail=str(e)
-            )
-    
-    settings = crud.update_user_settings(
+    # Macro percentages are checked by UserSettingsUpdate's model validator
+    settings = await run_in_threadpool(
+        crud.update_user_settings,
         db,
         user_id=current_user.id,
         macro_enabled=settings_data.macro_enabled,
@@ -507,6 +678,9 @@ def update_settings(
         carbs_pct=settings_data.carbs_pct,
         fat_pct=settings_data.fat_pct
     )
+    await cache.invalidate_user_settings(current_user.id)
+    # Again after the response, in case a racing read re-cached the old row
+    background_tasks.add_task(cache.invalidate_user_settings, current_user.id)
     return settings
 
 
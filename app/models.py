@@ -1,10 +1,38 @@
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text, Float, Boolean
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text, Float, Boolean, Index, UniqueConstraint
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.orm import relationship
+from sqlalchemy.sql.expression import FunctionElement
 
 from app.database import Base
 
 
+class utcnow(FunctionElement):
+    """Current UTC time with sub-second resolution, evaluated by the database.
+
+    Matches the naive-UTC datetime.utcnow values stored in every other column.
+    """
+    type = DateTime()
+    inherit_cache = True
+
+
+@compiles(utcnow)
+def _utcnow_default(element, compiler, **kw):
+    return "CURRENT_TIMESTAMP"
+
+
+@compiles(utcnow, "sqlite")
+def _utcnow_sqlite(element, compiler, **kw):
+    # CURRENT_TIMESTAMP only has whole seconds on SQLite
+    return "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+
+
+@compiles(utcnow, "postgresql")
+def _utcnow_postgresql(element, compiler, **kw):
+    # now() is in the session time zone; normalise to naive UTC
+    return "timezone('utc', statement_timestamp())"
+
+
 class User(Base):
     __tablename__ = "users"
 
@@ -40,18 +68,25 @@ class User(Base):
 
 class ChatSession(Base):
     __tablename__ = "chat_sessions"
+    __table_args__ = (
+        # Serves "a user's chats, most recently updated first" without a sort
+        Index("ix_chat_sessions_user_updated", "user_id", "updated_at"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(
         Integer,
         ForeignKey("users.id", ondelete="CASCADE"),
-        nullable=False,
-        index=True
+        nullable=False
     )
     title = Column(String(255), default="New Meal")
     created_at = Column(DateTime, default=datetime.utcnow)
+    # Inserts share created_at's clock; later bumps are computed by the database
     updated_at = Column(
-        DateTime, default=datetime.utcnow, onupdate=datetime.utcnow
+        DateTime,
+        default=datetime.utcnow,
+        server_default=utcnow(),
+        onupdate=utcnow(),
     )
 
     user = relationship("User", back_populates="chat_sessions")
@@ -65,14 +100,17 @@ class ChatSession(Base):
 
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (
+        # Serves "messages of a chat in order" without a sort step
+        Index("ix_messages_chat_created", "chat_id", "created_at"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     chat_id = Column(
         Integer,
         ForeignKey("chat_sessions.id", ondelete="CASCADE"),
         nullable=False,
-        index=True,
-    )
+    )  # Indexed as the leading column of ix_messages_chat_created
     role = Column(String(20), nullable=False)
     content = Column(Text, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
@@ -82,15 +120,19 @@ class Message(Base):
 
 class Ingredient(Base):
     __tablename__ = "ingredients"
+    __table_args__ = (
+        # Conflict target for the upsert on CSV re-upload
+        UniqueConstraint("user_id", "name", name="uq_ingredients_user_name"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(
         Integer,
         ForeignKey("users.id", ondelete="CASCADE"),
-        nullable=False,
-        index=True
+        nullable=False
     )
-    name = Column(String(255), nullable=False, index=True)
+    # Looked up through uq_ingredients_user_name; no separate name index
+    name = Column(String(255), nullable=False)
     calories_per_gram = Column(Float, nullable=False)
     protein_per_gram = Column(Float, nullable=False)
     fat_per_gram = Column(Float, nullable=False)
@@ -1,8 +1,13 @@
 from datetime import datetime
-from pydantic import BaseModel, EmailStr, Field, field_validator
+from pydantic import BaseModel, ConfigDict, EmailStr, Field, field_validator, model_validator
 from typing import List, Optional
 
 
+class APIModel(BaseModel):
+    """Base for response schemas: read-only, built from ORM attributes."""
+    model_config = ConfigDict(from_attributes=True, frozen=True)
+
+
 # User schemas
 class UserBase(BaseModel):
     email: EmailStr
@@ -19,27 +24,21 @@ class UserLogin(BaseModel):
     password: str
 
 
-class UserResponse(UserBase):
+class UserResponse(UserBase, APIModel):
     id: int
     full_name: Optional[str]
     is_active: bool
     is_verified: bool
     created_at: datetime
 
-    class Config:
-        from_attributes = True
-
 
-class UserProfile(BaseModel):
+class UserProfile(APIModel):
     id: int
     email: EmailStr
     username: str
     full_name: Optional[str]
     created_at: datetime
 
-    class Config:
-        from_attributes = True
-
 
 class UserUpdate(BaseModel):
     email: Optional[EmailStr] = None
@@ -61,7 +60,7 @@ class PasswordReset(BaseModel):
     new_password: str = Field(..., min_length=8)
 
 
-class Token(BaseModel):
+class Token(APIModel):
     access_token: str
     token_type: str
 
@@ -70,35 +69,52 @@ class TokenData(BaseModel):
     user_id: Optional[int] = None
 
 
+class MessageResponse(APIModel):
+    message: str
+
+
+class PasswordResetRequested(MessageResponse):
+    token: Optional[str] = None
+
+
+class StatusResponse(APIModel):
+    status: str
+
+
+class ConfigResponse(APIModel):
+    model: str
+    api_base: str
+
+
 # Message schemas
 class MessageCreate(BaseModel):
     content: str
 
 
-class MessageRead(BaseModel):
+class MessageRead(APIModel):
     id: int
     chat_id: int
     role: str
     content: str
     created_at: datetime
 
-    class Config:
-        from_attributes = True
+
+class ChatTurn(APIModel):
+    chat_id: int
+    user_message: str
+    assistant_message: str
 
 
 class ChatCreate(BaseModel):
     title: str | None = "New Meal"
 
 
-class ChatRead(BaseModel):
+class ChatRead(APIModel):
     id: int
     title: str
     created_at: datetime
     updated_at: datetime
 
-    class Config:
-        from_attributes = True
-
 
 class ChatDetail(ChatRead):
     messages: List[MessageRead] = []
@@ -112,12 +128,18 @@ class IngredientBase(BaseModel):
     carbs_per_gram: float
 
 
-class IngredientRead(IngredientBase):
+class IngredientRead(IngredientBase, APIModel):
     id: int
     created_at: datetime
 
-    class Config:
-        from_attributes = True
+
+class IngredientUploadResult(APIModel):
+    message: str
+    count: int
+
+
+class IngredientCount(APIModel):
+    count: int
 
 
 # User Settings schemas
@@ -134,15 +156,20 @@ class UserSettingsUpdate(BaseModel):
             raise ValueError('Percentage must be between 0 and 100')
         return v
 
+    @model_validator(mode='after')
     def validate_sum(self):
-        """Validate that percentages sum to 100 when all are provided"""
-        if self.macro_enabled and self.protein_pct is not None and self.carbs_pct is not None and self.fat_pct is not None:
-            total = self.protein_pct + self.carbs_pct + self.fat_pct
+        """Require all three percentages, summing to 100, when macros are enabled"""
+        if self.macro_enabled:
+            values = (self.protein_pct, self.carbs_pct, self.fat_pct)
+            if None in values:
+                raise ValueError('All macro percentages (protein, carbs, fat) are required when macro composition is enabled')
+            total = sum(values)
             if total != 100:
                 raise ValueError(f'Macro percentages must sum to 100, got {total}')
+        return self
 
 
-class UserSettingsResponse(BaseModel):
+class UserSettingsResponse(APIModel):
     id: int
     user_id: int
     macro_enabled: bool
@@ -151,6 +178,3 @@ class UserSettingsResponse(BaseModel):
     fat_pct: Optional[int]
     created_at: datetime
     updated_at: datetime
-
-    class Config:
-        from_attributes = True